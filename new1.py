@@ -1,8 +1,13 @@
 import os
+import copy
+import math
+import tempfile
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.optim as optim
+import torch.multiprocessing as mp
 import openseespy.opensees as ops
 
 
@@ -11,16 +16,32 @@ import openseespy.opensees as ops
 # --------------------------
 class BuildingEnv10Floors:
 
+    # 地震波缓存: 同一进程内多个环境共享同一份数据
+    _ACC_CACHE = {}
+
+    @classmethod
+    def _load_acc(cls, path):
+        acc = cls._ACC_CACHE.get(path)
+        if acc is None:
+            # 地震波输入不需要 float64 精度
+            acc = np.loadtxt(path, dtype=np.float32)
+            cls._ACC_CACHE[path] = acc
+        return acc
+
     def __init__(self, accel_file="accel.txt", dt=0.02, code_drift=1 / 100.0):
         # 读取地震波(3000行)
-        self.acc_data = np.loadtxt(accel_file)
+        self.accel_file = accel_file
+        self.acc_data = self._load_acc(accel_file)
         self.num_steps = len(self.acc_data)
 
         self.dt = dt
         self.floor_num = 10
         self.code_drift = code_drift  # 层间位移角限值(暂定1/100)
-        self.episode_count = 0  # 开始时wipe + rebuild
-        self.model_built = False
+        self._floor_nodes = list(range(2, self.floor_num + 2))  # 楼层节点 2~11
+        self._max_disps = np.zeros(self.floor_num)  # 各楼层最大绝对位移, 各回合复用
+        self._mat_tag = 1
+        self._damper_tag = self.floor_num  # 楼层链接占用单元 1~9
+        self._damper_floor = None  # 当前阻尼器所在楼层
 
         # 状态空间与动作空间（示例：状态仅用上一次的 alphavalue；动作为 10 种可能楼层）
         # 状态: shape=(1,) => [alphavalue]
@@ -28,6 +49,16 @@ class BuildingEnv10Floors:
         self.state_dim = 1
         self.action_dim = self.floor_num
 
+        # 楼层位移记录文件: 只打开一次, 每步写一行(楼层1..10)
+        os.makedirs("floor_disp", exist_ok=True)
+        self._disp_file = open("floor_disp/floor_disp.csv", "a")
+        # EnvelopeNode 记录器的临时输出文件(每个进程一个)
+        fd, self._envelope_file = tempfile.mkstemp(prefix="floor_envelope_", suffix=".txt")
+        os.close(fd)
+
+        # 建立基础模型(只建一次, 之后各回合复用同一个 Domain)
+        self.build_model()
+
         # 初始化
         self.reset()
 
@@ -40,11 +71,6 @@ class BuildingEnv10Floors:
 
     def step(self, action):
 
-        self.episode_count += 1
-        if (self.episode_count % 10) == 1:
-            # 每10轮重新wipe并建模，防止溢出
-            self.build_model()
-
         # 运行分析
         damper_floor = action + 1  # 动作0 => 第1层, 动作1 => 第2层, ...
         alphavalue, max_disps = self.run_opensees_analysis(damper_floor)
@@ -65,103 +91,195 @@ class BuildingEnv10Floors:
         return next_state, reward, done, {}
 
     def build_model(self):
-        #备份部分
-        ops.wipe()
-        self.model_built = True
-
-        pass
-
-    def run_opensees_analysis(self, damper_floor): #opensees主程序
-
-        # 1) 清理
+        # 基础模型只建立一次; 回合之间只替换阻尼器单元
         ops.wipe()
 
-        # 2) 建模
+        # 建模
         ops.model('basic', '-ndm', 1, '-ndf', 1)
 
-        # 创建节点 1~11
+        # 创建节点 1~11, 楼层节点(2~11)同时赋质量
+        mass_per_floor = 1.0e5
         for i in range(self.floor_num + 1):
             nodeTag = i + 1
             ops.node(nodeTag, float(i) * 3.0)
+            if i >= 1:
+                ops.mass(nodeTag, mass_per_floor)
         # 固定底部
         ops.fix(1, 1)
 
-        # 质量
-        mass_per_floor = 1.0e5
-        for nd in range(2, self.floor_num + 2):
-            ops.mass(nd, mass_per_floor)
-
         # 弹簧材料
-        matTag = 1
+        matTag = self._mat_tag
         k_floor = 1.0e8
         ops.uniaxialMaterial('Elastic', matTag, k_floor)
 
-        # 相邻楼层链接
+        # 相邻楼层链接(单元 1~9)
         elementTag = 1
         for i in range(1, self.floor_num):
             ops.element('twoNodeLink', elementTag, i + 1, i + 2,
                         '-mat', matTag, '-dir', 1)
             elementTag += 1
 
-        # 在指定楼层添加阻尼器(假设 material 一样，也可以换另一个 matTag)
-        if 1 <= damper_floor < self.floor_num:
-            ops.element('twoNodeLink', elementTag, damper_floor, damper_floor + 1,
-                        '-mat', matTag, '-dir', 1)
-            elementTag += 1
-
-        # 3) 加速度输入
-        ops.timeSeries('Path', 1, '-dt', self.dt, '-values', *self.acc_data)
+        # 加速度输入
+        # 由 OpenSees 直接读取文件, 避免把 3000 个数值逐个传入
+        ops.timeSeries('Path', 1, '-dt', self.dt, '-filePath', self.accel_file, '-factor', 1.0)
         ops.pattern('UniformExcitation', 1, 1, '-accel', 1)
 
-        # 4) 阻尼
+        # 阻尼
         zeta = 0.02
         alphaM = 0.0
         betaK = 0.0
         ops.rayleigh(alphaM, betaK, 0.0, 0.0)
 
-        # 5) 分析选项
-        ops.system('BandGeneral')
-        ops.numberer('Plain')
+        # 分析选项
+        # 链式 1 自由度模型: 有效刚度矩阵对称正定, 用对称带状求解器 + RCM 编号
+        ops.system('BandSPD')
+        ops.numberer('RCM')
         ops.constraints('Plain')
         ops.integrator('Newmark', 0.5, 0.25)
-        ops.algorithm('Newton')
+        ops.algorithm('Linear')  # 线弹性模型, 每步一次求解即可, 无需 Newton 迭代
         ops.analysis('Transient')
 
-        # 6) 时程分析 (3000 步)
-        max_disps = np.zeros(self.floor_num)  # 仅记录楼层节点(2~11)
-        for step in range(self.num_steps):
-            ok = ops.analyze(1, self.dt)
-            if ok != 0:
-                break
-            # 记录最大位移
-            for nd in range(2, self.floor_num + 2):
-                d = ops.nodeDisp(nd, 1)
-                index = nd - 2  # 0~9
-                if abs(d) > abs(max_disps[index]):
-                    max_disps[index] = d
-
-        # 7) 计算最大层间位移角
-        max_story_drift = 0.0
-        for i in range(self.floor_num - 1):
-            drift = abs(max_disps[i + 1] - max_disps[i]) / 3.0  # 层高3.0
-            if drift > max_story_drift:
-                max_story_drift = drift
-
-        # 8) 计算 alphavalue = |(max_story_drift) - (规范限值)|
+        self._damper_floor = None
+
+    def run_opensees_analysis(self, damper_floor): #opensees主程序
+
+        # 1) 移除上一回合的阻尼器
+        if self._damper_floor is not None:
+            ops.remove('ele', self._damper_tag)
+            self._damper_floor = None
+
+        # 2) 在指定楼层添加阻尼器(假设 material 一样，也可以换另一个 matTag)
+        if 1 <= damper_floor < self.floor_num:
+            ops.element('twoNodeLink', self._damper_tag, damper_floor, damper_floor + 1,
+                        '-mat', self._mat_tag, '-dir', 1)
+            self._damper_floor = damper_floor
+
+        # 3) 恢复到初始状态(位移/速度/时间归零)
+        ops.reset()
+
+        # 4) 时程分析 (3000 步): 由 EnvelopeNode 记录器在 C++ 中统计楼层节点(2~11)的位移包络,
+        #    一次 analyze 完成全部步数(若中途不收敛, OpenSees 会在该步停止)
+        recorderTag = ops.recorder('EnvelopeNode', '-file', self._envelope_file, '-precision', 10,
+                                   '-node', *self._floor_nodes, '-dof', 1, 'disp')
+        ops.analyze(self.num_steps, self.dt)
+        ops.remove('recorder', recorderTag)  # 移除时写出并关闭文件
+
+        # 包络文件三行依次为 min / max / abs max, 取最大绝对位移
+        max_disps = self._max_disps
+        max_disps.fill(0.0)
+        envelope = np.loadtxt(self._envelope_file, ndmin=2)
+        if envelope.shape[0] >= 3:
+            np.copyto(max_disps, envelope[2])
+
+        # 5) 计算最大层间位移角(层高3.0)
+        max_story_drift = float(np.max(np.abs(np.diff(max_disps)))) / 3.0
+
+        # 6) 计算 alphavalue = |(max_story_drift) - (规范限值)|
         alphavalue = abs(max_story_drift - self.code_drift)
 
         return alphavalue, max_disps
 
+    def close(self):
+        if not self._disp_file.closed:
+            self._disp_file.close()
+        if os.path.exists(self._envelope_file):
+            os.remove(self._envelope_file)
+
     def _save_floor_disps(self, max_disps):
        #记录部分
-        if not os.path.exists("floor_disp"):
-            os.makedirs("floor_disp")
-        # max_disps[0] => 楼层1, max_disps[1] => 楼层2, ...
-        for i in range(self.floor_num):
-            floor_index = i + 1
-            filename = f"floor_disp/floor{floor_index}_disp.txt"
-            with open(filename, "a") as f:
-                f.write(f"{max_disps[i]:.6e}\n")
+        # max_disps[0] => 楼层1, max_disps[1] => 楼层2, ... 合并为一行, 一次写入
+        np.savetxt(self._disp_file, max_disps.reshape(1, -1), fmt='%.6e', delimiter=',')
+        self._disp_file.flush()
+
+
+# --------------------------
+# 2. 多进程并行环境
+# --------------------------
+def _env_worker(remote, env_kwargs, seed):
+    # 每个子进程持有独立的 OpenSees 模型(OpenSees 的模型是进程内全局状态)
+    torch.manual_seed(seed)  # 各进程采样互不相同
+    torch.set_num_threads(1)
+    env = BuildingEnv10Floors(**env_kwargs)
+    policy = None
+    try:
+        while True:
+            cmd, data = remote.recv()
+            if cmd == "rollout":
+                # 用共享内存中的策略网络在子进程内采样, 只回传 (state, action, reward)
+                state = env.reset()
+                action = int(policy.sample_action(state[None])[0])
+                next_state, reward, done, info = env.step(action)
+                remote.send((state, action, reward))
+            elif cmd == "policy":
+                policy = data
+            elif cmd == "step":
+                remote.send(env.step(data))
+            elif cmd == "reset":
+                remote.send(env.reset())
+            elif cmd == "spaces":
+                remote.send((env.state_dim, env.action_dim))
+            elif cmd == "close":
+                break
+    finally:
+        env.close()
+        remote.close()
+
+
+class VecBuildingEnv:
+
+    def __init__(self, num_envs, **env_kwargs):
+        # N 个子进程各跑一个环境, N 个回合同时进行
+        self.num_envs = num_envs
+        self.remotes, self.processes = [], []
+        for rank in range(num_envs):
+            remote, work_remote = mp.Pipe()
+            seed = torch.initial_seed() + rank + 1
+            p = mp.Process(target=_env_worker, args=(work_remote, env_kwargs, seed), daemon=True)
+            p.start()
+            work_remote.close()
+            self.remotes.append(remote)
+            self.processes.append(p)
+
+        self.remotes[0].send(("spaces", None))
+        self.state_dim, self.action_dim = self.remotes[0].recv()
+
+    def set_policy(self, policy):
+        # policy 需先调用 share_memory(), 子进程拿到的是同一份参数, 之后无需再传输
+        for remote in self.remotes:
+            remote.send(("policy", policy))
+
+    def rollout(self):
+        # 每个子进程用共享策略各跑一个回合
+        for remote in self.remotes:
+            remote.send(("rollout", None))
+        states, actions, rewards = zip(*[remote.recv() for remote in self.remotes])
+        return (np.stack(states),
+                np.array(actions, dtype=np.int64),
+                np.array(rewards, dtype=np.float32))
+
+    def reset(self):
+        for remote in self.remotes:
+            remote.send(("reset", None))
+        # shape=(N, state_dim)
+        return np.stack([remote.recv() for remote in self.remotes])
+
+    def step(self, actions):
+        for remote, action in zip(self.remotes, actions):
+            remote.send(("step", int(action)))
+        results = [remote.recv() for remote in self.remotes]
+        next_states, rewards, dones, infos = zip(*results)
+        return (np.stack(next_states),
+                np.array(rewards, dtype=np.float32),
+                np.array(dones),
+                list(infos))
+
+    def close(self):
+        for remote in self.remotes:
+            remote.send(("close", None))
+        for p in self.processes:
+            p.join()
+        for remote in self.remotes:
+            remote.close()
 
 
 #神经网络部分
@@ -176,61 +294,100 @@ class PolicyNetwork(nn.Module):
             nn.ReLU(),
             nn.Linear(hidden_size, action_dim),
         )
+        # BF16 副本只用于采样; 训练(logp/Adam)仍用 FP32 的 self.net
+        self._net_bf16 = copy.deepcopy(self.net).to(torch.bfloat16).requires_grad_(False)
+
+    def sync_inference_net(self):
+        # optimizer.step() 之后调用, 原地拷贝以保持共享内存不变
+        with torch.no_grad():
+            for p_bf16, p in zip(self._net_bf16.parameters(), self.net.parameters()):
+                p_bf16.copy_(p)
 
     def forward(self, x):
         # 返回每个动作的评分，然后需要 softmax
         logits = self.net(x)
         return logits
 
-    def get_action_and_logp(self, state):
+    @staticmethod
+    def _to_tensor(states):
+        # from_numpy 直接共享内存(环境状态已是 float32), 不经过 Python 列表复制
+        return torch.from_numpy(np.asarray(states, dtype=np.float32))  # shape=(N, state_dim)
 
-        x = torch.FloatTensor(state).unsqueeze(0)  # shape=(1, state_dim)
-        logits = self.forward(x)  # shape=(1, action_dim)
-        probs = torch.softmax(logits, dim=-1)  # shape=(1, action_dim)
+    def sample_action(self, states):
+        # 只采样, 不记录梯度(子进程中使用), 用 BF16 副本前向
+        with torch.inference_mode():
+            logits = self._net_bf16(self._to_tensor(states).to(torch.bfloat16))
+            action = torch.multinomial(torch.softmax(logits.float(), dim=-1), 1)  # shape=(N, 1)
+        return action.squeeze(-1).numpy()
 
-        # 从这个分布中采样
-        dist = torch.distributions.Categorical(probs=probs)
-        action = dist.sample()  # shape=(1,)
-        logp = dist.log_prob(action)  # shape=(1,)
+    def log_prob(self, states, actions):
+        # 计算给定动作的 logp(带梯度, 供 REINFORCE 更新)
+        logits = self.forward(self._to_tensor(states))  # shape=(N, action_dim)
+        logp_all = F.log_softmax(logits, dim=-1)
+        index = torch.from_numpy(np.asarray(actions, dtype=np.int64)).unsqueeze(-1)
+        return logp_all.gather(-1, index).squeeze(-1)  # shape=(N,)
 
-        return action.item(), logp
+    def get_action_and_logp(self, states):
 
+        # BF16 副本采样, FP32 网络计算带梯度的 logp
+        action = self.sample_action(states)  # shape=(N,)
+        logp = self.log_prob(states, action)  # shape=(N,)
 
+        return action, logp
 
-def train_rl_model(num_episodes=200,
-                   lr=1e-3,
-                   gamma=0.99):
-    # 1) 创建环境 & 策略网络 & 优化器
-    env = BuildingEnv10Floors(accel_file="accel.txt")
-    policy = PolicyNetwork(env.state_dim, env.action_dim, hidden_size=64)
-    optimizer = optim.Adam(policy.parameters(), lr=lr)
-
-    # 2) 开始训练
-    for episode in range(num_episodes):
-        # 重置环境
-        state = env.reset()
 
-        # 用策略网络采样动作
-        action, logp = policy.get_action_and_logp(state)
 
-        # 与环境交互
-        next_state, reward, done, info = env.step(action)
+def train_rl_model(num_episodes=200,
+                   lr=1e-3,
+                   gamma=0.99,
+                   num_envs=4,
+                   episodes_per_update=8):
+    # 1) 创建并行环境 & 策略网络 & 优化器
+    envs = VecBuildingEnv(num_envs, accel_file="accel.txt")
+    policy = PolicyNetwork(envs.state_dim, envs.action_dim, hidden_size=64)
+    # 参数放入共享内存, 子进程直接读取; optimizer.step() 原地更新后子进程立即可见
+    policy.share_memory()
+    envs.set_policy(policy)
+    # 每次更新累积的回合数取 num_envs 的整数倍
+    rollouts_per_update = math.ceil(episodes_per_update / num_envs)
+    batch_size = rollouts_per_update * num_envs
+    # 主进程中编译 FP32 网络(log_prob 的前向); 每次 batch 形状固定为 (batch_size, state_dim)
+    # 在 set_policy 之后编译, 子进程仍使用未编译的 BF16 副本采样
+    policy.net.compile(mode='reduce-overhead', dynamic=False)
+    optimizer = optim.Adam(policy.net.parameters(), lr=lr)
+
+    # 2) 开始训练: 每次迭代累积 batch_size 个回合后更新一次(总回合数向上取整)
+    num_iters = math.ceil(num_episodes / batch_size)
+    episode = 0
+    for it in range(num_iters):
+        # 各子进程用共享策略采样动作并与环境交互, 共 rollouts_per_update 轮
+        batch = [envs.rollout() for _ in range(rollouts_per_update)]
+        states = np.concatenate([b[0] for b in batch])
+        actions = np.concatenate([b[1] for b in batch])
+        rewards = np.concatenate([b[2] for b in batch])
+
+        # 在主进程中重新计算 logp(需要梯度)
+        logps = policy.log_prob(states, actions)
 
         # 计算回报(因为是单步回合，这里回报就是 reward 本身)
         # 如果要多步，可以记录 trajectory，再计算梯度
-        G = reward  # 单步直接是 reward
+        G = torch.from_numpy(rewards)  # 单步直接是 reward
 
-        # 计算损失 = - logp * G
-        loss = -logp * G
+        # 计算损失 = - logp * G, 对 batch_size 个回合取平均
+        loss = -(logps * G).mean()
 
-        # 反向传播
-        optimizer.zero_grad()
+        # 反向传播(每 batch_size 个回合一次批量更新)
         loss.backward()
         optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        policy.sync_inference_net()
 
         # 打印
-        print(f"Episode [{episode + 1}/{num_episodes}], Action={action}, Reward={reward:.6f}, Loss={loss.item():.6f}")
+        for action, reward in zip(actions, rewards):
+            episode += 1
+            print(f"Episode [{episode}/{num_iters * batch_size}], Action={action}, Reward={reward:.6f}, Loss={loss.item():.6f}")
 
+    envs.close()
     print("训练结束！")
 
 # 主函数入口